@@ -0,0 +1,29 @@
+# Ahead-of-time compile the scoring kernel from sorting_toi.py
+# Run (once, or after changing the scoring constants):
+# python build_ranker_aot.py
+#
+# Produces ranker_aot.*.so next to sorting_toi.py, which then imports it
+# instead of JIT-compiling _score_kernel on every fresh interpreter.
+# sorting_toi.py ignores (and warns about) a build whose constants_hash()
+# no longer matches its current scoring constants.
+
+import os
+from numba.pycc import CC
+
+from sorting_toi import _score_kernel, _score_constants_hash
+
+cc = CC('ranker_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# rank_candidates passes the six scoring columns as float32 arrays
+cc.export('score', 'UniTuple(f4[:], 3)(f4[:], f4[:], f4[:], f4[:], f4[:], f4[:])')(_score_kernel)
+
+CONSTANTS_HASH = _score_constants_hash()
+
+@cc.export('constants_hash', 'i8()')
+def constants_hash():
+    return CONSTANTS_HASH
+
+
+if __name__ == "__main__":
+    cc.compile()
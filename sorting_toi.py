@@ -2,17 +2,39 @@
 # Run:
 # python sorting_toi.py --toi_csv tois.csv
 
+import os
 import re
+import glob
 import numpy as np
 import pandas as pd
 import argparse
+import functools
+import hashlib
+import warnings
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+except ImportError:  # optional: fall back to the default CSV engine
+    pyarrow = None
+
+try:
+    import hyperscan
+except ImportError:  # optional: fall back to str.contains for the comment gate
+    hyperscan = None
+
+try:
+    import joblib
+except ImportError:  # optional: batch mode runs the snapshots one by one
+    joblib = None
 
 # Defaults
 TEFF_MIN, TEFF_MAX       = 2400.0, 4000.0   # K
 LOGG_MIN                 = 4.3
 RSTAR_MIN, RSTAR_MAX     = 0.1, 0.7         # R_sun
 
-TESS_DISP_OK             = {"PC"}
+TESS_DISP_OK             = "PC"
 TESS_MAG_CUTOFF          = 14.0
 
 # Brightness reference range used for normalization
@@ -23,6 +45,10 @@ PERIOD_PIVOT_D, PERIOD_MAX_D = 5.0, 15.0
 
 DUR_MIN_H, DUR_PEAK_H, DUR_MAX_H = 0.5, 2.0, 5.0
 
+# Below this many rows the NumPy scorer beats importing numba and loading the kernel
+# (~0.3 s up front vs ~50 ms saved per million rows)
+NUMBA_MIN_ROWS = 5_000_000
+
 COMMENT_FLAGS = [
     'v-shaped','v shaped','eb','eclips','odd-even','sb2','binary',
     'fp','false positive','retired','low snr','contamin','centroid offset'
@@ -31,71 +57,123 @@ COMMENT_FLAGS = [
 #COMMENT_FLAGS = []
 
 # Regex: case-insensitive; handle v-shaped/v shaped; add word boundaries for key phrases
+# (ASCII \b, matching the RE2 and Hyperscan backends)
 FLAGS_PATTERN = re.compile(
     r'(?:v[ -]?shaped|\beb\b|eclips|odd-even|\bsb2\b|\bbinary\b|fp|false positive|\blow snr\b|contamin|centroid offset)',
-    flags=re.IGNORECASE
+    flags=re.IGNORECASE | re.ASCII
 )
 
+# Same alternation as a Hyperscan DFA, compiled once (bulk comment scanning)
+if hyperscan is not None:
+    FLAGS_DB = hyperscan.Database()
+    FLAGS_DB.compile(expressions=[FLAGS_PATTERN.pattern.encode()],
+                     flags=[hyperscan.HS_FLAG_CASELESS])
+else:
+    FLAGS_DB = None
+
 NUM_COLS = [
     'Stellar Eff Temp (K)', 'Stellar log(g) (cm/s^2)', 'Stellar Radius (R_Sun)',
     'TESS Mag', 'Depth (ppm)', 'Period (days)', 'Duration (hours)'
 ]
 
-def filter_candidates(df: pd.DataFrame) -> pd.DataFrame:
-    # Coerce numeric columns
-    df = df.copy()
-    for col in NUM_COLS:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-
-    # Vectorized comment flag
-    comments = df.get('Comments', pd.Series(index=df.index, dtype=object))
-    flagged = comments.fillna('').str.contains(FLAGS_PATTERN, na=False)
-
-    gate = (
-        df['TESS Disposition'].isin(TESS_DISP_OK) &
-        df['Stellar Eff Temp (K)'].between(TEFF_MIN, TEFF_MAX, inclusive='both') &
-        (df['Stellar log(g) (cm/s^2)'] >= LOGG_MIN) &
-        (df['Stellar Radius (R_Sun)'] <= RSTAR_MAX) &
-        (df['TESS Mag'] <= TESS_MAG_CUTOFF) &
-        (df['Depth (ppm)'] >= DEPTH_PPM_MIN) &
-        (df['Period (days)'] <= PERIOD_MAX_D) &
-        df['Duration (hours)'].between(DUR_MIN_H, DUR_MAX_H, inclusive='both') &
-        (~flagged)
+def _view(df: pd.DataFrame, col: str, dtype=np.float64) -> np.ndarray:
+    # Zero-copy (read-only) view of a single-chunk, null-free Arrow column of the
+    # requested dtype; anything else goes through the usual to_numpy conversion
+    s = df[col]
+    if isinstance(s.dtype, pd.ArrowDtype):
+        arr = pyarrow.chunked_array(s)
+        if (arr.num_chunks == 1 and arr.null_count == 0
+                and np.dtype(arr.type.to_pandas_dtype()) == np.dtype(dtype)):
+            return arr.chunk(0).to_numpy(zero_copy_only=True)
+    return s.to_numpy(dtype=dtype)
+
+def flagged_mask(comments: pd.Series) -> np.ndarray:
+    if isinstance(comments.dtype, pd.ArrowDtype):
+        # An all-empty Comments column is read as null[pyarrow]; make it a string column
+        comments = comments.astype(pd.ArrowDtype(pyarrow.large_string()))
+    comments = comments.fillna('')
+    if FLAGS_DB is None or pyarrow is None or len(comments) == 0:
+        if isinstance(comments.dtype, pd.ArrowDtype) or getattr(comments.dtype, 'storage', None) == 'pyarrow':
+            # Arrow strings run RE2 on the pattern text (they reject an re.Pattern)
+            flagged = comments.str.contains(FLAGS_PATTERN.pattern, case=False, na=False)
+        else:
+            # Reuse the precompiled pattern; no re.compile per call
+            flagged = comments.str.contains(FLAGS_PATTERN, na=False, regex=True)
+        return flagged.to_numpy(dtype=bool)
+
+    # One DFA scan over the Arrow data buffer with every comment terminated by
+    # '\n'. No FLAGS_PATTERN alternative can match '\n', so matches never cross
+    # rows (newlines inside a comment stay, as in re/RE2), and \b treats the
+    # terminator like a string edge.
+    arr = pyarrow.array(comments, type=pyarrow.large_string(), from_pandas=True)
+    if isinstance(arr, pyarrow.ChunkedArray):
+        arr = arr.combine_chunks()
+    arr = pyarrow.compute.binary_join_element_wise(
+        arr,
+        pyarrow.scalar('\n', type=pyarrow.large_string()),
+        pyarrow.scalar('', type=pyarrow.large_string()),
     )
-    return df[gate].copy()
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64)[arr.offset:arr.offset + len(arr) + 1]
+    ends = []
+    FLAGS_DB.scan(arr.buffers()[2], match_event_handler=lambda _id, _start, end, _flags, _ctx: ends.append(end))
 
-def rank_candidates(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
+    # Row i owns bytes [offsets[i], offsets[i+1]); a match ending at (exclusive)
+    # byte `end` has its last byte at end - 1, so its row is the last offset <= end - 1
+    out = np.zeros(len(comments), dtype=bool)
+    out[np.searchsorted(offsets, np.asarray(ends, dtype=np.int64) - 1, side='right') - 1] = True
+    return out
 
-    # Convenience aliases
-    teff   = df['Stellar Eff Temp (K)']
-    rstar  = df['Stellar Radius (R_Sun)']
-    tmag   = df['TESS Mag']
-    depth  = df['Depth (ppm)']
-    period = df['Period (days)']
-    dur    = df['Duration (hours)']
+def filter_candidates(df: pd.DataFrame) -> pd.DataFrame:
+    # Coerce numeric columns (assign returns a new frame; caller's df untouched)
+    df = df.assign(**{col: pd.to_numeric(df[col], errors='coerce')
+                      for col in NUM_COLS if col in df.columns})
 
+    # Vectorized comment flag
+    flagged = flagged_mask(df.get('Comments', pd.Series(index=df.index, dtype=object)))
+
+    # Gate on raw ndarrays, reusing one boolean buffer (NaN compares False)
+    teff   = _view(df, 'Stellar Eff Temp (K)')
+    logg   = _view(df, 'Stellar log(g) (cm/s^2)')
+    rstar  = _view(df, 'Stellar Radius (R_Sun)')
+    tmag   = _view(df, 'TESS Mag')
+    depth  = _view(df, 'Depth (ppm)')
+    period = _view(df, 'Period (days)')
+    dur    = _view(df, 'Duration (hours)')
+
+    gate = (teff >= TEFF_MIN)
+    gate &= df['TESS Disposition'].eq(TESS_DISP_OK).to_numpy(dtype=bool, na_value=False)
+    gate &= (teff <= TEFF_MAX)
+    gate &= (logg >= LOGG_MIN)
+    gate &= (rstar <= RSTAR_MAX)
+    gate &= (tmag <= TESS_MAG_CUTOFF)
+    gate &= (depth >= DEPTH_PPM_MIN)
+    gate &= (period <= PERIOD_MAX_D)
+    gate &= (dur >= DUR_MIN_H)
+    gate &= (dur <= DUR_MAX_H)
+    gate &= ~flagged
+    return df.iloc[gate]
+
+def _score_numpy(teff, rstar, tmag, depth, period, dur):
     # Stellar merit (cooler, smaller better)
     m_teff = (TEFF_MAX - teff) / max(1e-9, (TEFF_MAX - TEFF_MIN))
     m_rad  = (RSTAR_MAX - rstar) / max(1e-9, (RSTAR_MAX - RSTAR_MIN))
-    m_teff = m_teff.clip(0, 1).fillna(0.0)
-    m_rad  = m_rad.clip(0, 1).fillna(0.0)
+    m_teff = np.nan_to_num(np.clip(m_teff, 0, 1), nan=0.0)
+    m_rad  = np.nan_to_num(np.clip(m_rad, 0, 1), nan=0.0)
     score_m = 0.6 * m_teff + 0.4 * m_rad
 
     # Observability (brighter, deeper, shorter period, ~2 h duration)
     tbright = 1.0 - (tmag - TBRIGHT_MIN_REF) / max(1e-9, (TBRIGHT_MAX_REF - TBRIGHT_MIN_REF))
-    tbright = tbright.clip(0, 1).fillna(0.0)
+    tbright = np.nan_to_num(np.clip(tbright, 0, 1), nan=0.0)
 
     depth_s = (depth - DEPTH_PPM_MIN) / max(1e-9, (DEPTH_PPM_MAX - DEPTH_PPM_MIN))
-    depth_s = depth_s.clip(0, 1).fillna(0.0)
+    depth_s = np.nan_to_num(np.clip(depth_s, 0, 1), nan=0.0)
 
     period_s = 1.0 - (period - PERIOD_PIVOT_D) / max(1e-9, (PERIOD_MAX_D - PERIOD_PIVOT_D))
-    period_s = period_s.clip(0, 1).fillna(0.0)
+    period_s = np.nan_to_num(np.clip(period_s, 0, 1), nan=0.0)
 
     # Vectorized triangular duration
-    tri = np.zeros(len(df), dtype=float)
-    mask = dur.notna() & (dur > DUR_MIN_H) & (dur < DUR_MAX_H)
+    tri = np.zeros(len(dur), dtype=dur.dtype)
+    mask = ~np.isnan(dur) & (dur > DUR_MIN_H) & (dur < DUR_MAX_H)
     left = mask & (dur <= DUR_PEAK_H)
     right = mask & (dur > DUR_PEAK_H)
     tri[left]  = (dur[left]  - DUR_MIN_H) / max(1e-9, (DUR_PEAK_H - DUR_MIN_H))
@@ -106,17 +184,183 @@ def rank_candidates(df: pd.DataFrame) -> pd.DataFrame:
                  0.15 * period_s +
                  0.05 * tri)
 
-    df['score_m']        = score_m
-    df['score_obs']      = score_obs
-    df['priority_score'] = 0.5 * score_m + 0.5 * score_obs
-    return df
+    return score_m, score_obs, 0.5 * score_m + 0.5 * score_obs
+
+
+# Same math as _score_numpy, fused into one pass per row. Plain Python so it
+# can be JIT-compiled here or AOT-compiled by build_ranker_aot.py.
+def _score_kernel(teff, rstar, tmag, depth, period, dur):
+    n = teff.shape[0]
+    score_m   = np.empty_like(teff)
+    score_obs = np.empty_like(teff)
+    priority  = np.empty_like(teff)
+    for i in range(n):
+        # Clamp to [0, 1]; 'not (x > 0)' also maps NaN to 0
+        m_teff = (TEFF_MAX - teff[i]) / max(1e-9, (TEFF_MAX - TEFF_MIN))
+        m_teff = 0.0 if not (m_teff > 0.0) else min(m_teff, 1.0)
+        m_rad = (RSTAR_MAX - rstar[i]) / max(1e-9, (RSTAR_MAX - RSTAR_MIN))
+        m_rad = 0.0 if not (m_rad > 0.0) else min(m_rad, 1.0)
+
+        tbright = 1.0 - (tmag[i] - TBRIGHT_MIN_REF) / max(1e-9, (TBRIGHT_MAX_REF - TBRIGHT_MIN_REF))
+        tbright = 0.0 if not (tbright > 0.0) else min(tbright, 1.0)
+        depth_s = (depth[i] - DEPTH_PPM_MIN) / max(1e-9, (DEPTH_PPM_MAX - DEPTH_PPM_MIN))
+        depth_s = 0.0 if not (depth_s > 0.0) else min(depth_s, 1.0)
+        period_s = 1.0 - (period[i] - PERIOD_PIVOT_D) / max(1e-9, (PERIOD_MAX_D - PERIOD_PIVOT_D))
+        period_s = 0.0 if not (period_s > 0.0) else min(period_s, 1.0)
+
+        d = dur[i]
+        tri = 0.0
+        if d > DUR_MIN_H and d < DUR_MAX_H:
+            if d <= DUR_PEAK_H:
+                tri = (d - DUR_MIN_H) / max(1e-9, (DUR_PEAK_H - DUR_MIN_H))
+            else:
+                tri = 1.0 - (d - DUR_PEAK_H) / max(1e-9, (DUR_MAX_H - DUR_PEAK_H))
+
+        s_m = 0.6 * m_teff + 0.4 * m_rad
+        s_obs = 0.40 * tbright + 0.40 * depth_s + 0.15 * period_s + 0.05 * tri
+        score_m[i]   = s_m
+        score_obs[i] = s_obs
+        priority[i]  = 0.5 * s_m + 0.5 * s_obs
+    return score_m, score_obs, priority
+
+
+def _score_constants_hash() -> int:
+    # Fingerprint of everything ranker_aot freezes at build time: the scoring
+    # constants and the kernel's own bytecode/literals (weights)
+    code = _score_kernel.__code__
+    key = repr((TEFF_MIN, TEFF_MAX, RSTAR_MIN, RSTAR_MAX, TBRIGHT_MIN_REF, TBRIGHT_MAX_REF,
+                DEPTH_PPM_MIN, DEPTH_PPM_MAX, PERIOD_PIVOT_D, PERIOD_MAX_D,
+                DUR_MIN_H, DUR_PEAK_H, DUR_MAX_H, code.co_code.hex(), code.co_consts))
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:7], 'little')
+
+
+try:
+    # Ahead-of-time build of _score_kernel (python build_ranker_aot.py): no JIT cost
+    import ranker_aot
+except ImportError:
+    ranker_aot = None
+if ranker_aot is not None and ranker_aot.constants_hash() != _score_constants_hash():
+    warnings.warn("ranker_aot was built with different scoring constants; ignoring it "
+                  "(rebuild with: python build_ranker_aot.py)")
+    ranker_aot = None
+
+
+@functools.lru_cache(maxsize=None)
+def _score_jit():
+    # Import numba and compile (or load the cached) kernel on first large call only.
+    # Single-threaded: batch mode already runs one process per core.
+    try:
+        import numba
+    except ImportError:  # optional: fall back to the NumPy scorer
+        return None
+    # fastmath without 'nnan'/'ninf' so NaN inputs still clamp to 0
+    return numba.njit(cache=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})(_score_kernel)
+
+
+def _score(teff, rstar, tmag, depth, period, dur):
+    # Only called by rank_candidates; the AOT export is float32-only (other dtypes crash it)
+    arrays = (teff, rstar, tmag, depth, period, dur)
+    if any(a.dtype != np.float32 for a in arrays):
+        raise TypeError("_score expects float32 arrays, got "
+                        + ", ".join(str(a.dtype) for a in arrays))
+    if ranker_aot is not None:
+        return ranker_aot.score(*arrays)
+    if len(teff) >= NUMBA_MIN_ROWS:
+        kernel = _score_jit()
+        if kernel is not None:
+            return kernel(teff, rstar, tmag, depth, period, dur)
+    return _score_numpy(teff, rstar, tmag, depth, period, dur)
 
 
+def rank_candidates(df: pd.DataFrame) -> pd.DataFrame:
+    # Raw float32 arrays: scores only drive sort order, so halve the memory traffic
+    score_m, score_obs, priority = _score(
+        _view(df, 'Stellar Eff Temp (K)', np.float32),
+        _view(df, 'Stellar Radius (R_Sun)', np.float32),
+        _view(df, 'TESS Mag', np.float32),
+        _view(df, 'Depth (ppm)', np.float32),
+        _view(df, 'Period (days)', np.float32),
+        _view(df, 'Duration (hours)', np.float32),
+    )
+
+    # One shallow copy with the score columns appended
+    return df.assign(score_m=score_m, score_obs=score_obs, priority_score=priority)
+
+
+def top_k_order(scores: np.ndarray, k: int) -> np.ndarray:
+    # Positions of the k highest scores, best first: O(N + k log k) vs a full sort
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+
+def process_toi_csv(path: str, out_csv: str, top_k=None, parquet: bool = False):
+    # Read, filter, rank and write one TOI CSV; returns (all candidates, rows to print)
+    # Read and keep original column names (multithreaded Arrow parser if available)
+    read_kw = dict(engine='pyarrow', dtype_backend='pyarrow') if pyarrow is not None else {}
+    df = pd.read_csv(path, **read_kw)
+
+    # Filter and rank
+    cands = filter_candidates(df)
+    cands = rank_candidates(cands)
+    if top_k is None:
+        cands = cands.sort_values('priority_score', ascending=False).reset_index(drop=True)
+        top = cands
+    else:
+        top = cands.iloc[top_k_order(cands['priority_score'].to_numpy(), top_k)]
+
+    # Multithreaded Arrow CSV writer if available
+    if pyarrow is not None:
+        pyarrow.csv.write_csv(pyarrow.Table.from_pandas(cands, preserve_index=False), out_csv)
+    else:
+        cands.to_csv(out_csv, index=False)
+    if parquet:
+        cands.to_parquet(os.path.splitext(out_csv)[0] + ".parquet", engine='pyarrow',
+                         compression='zstd', index=False)
+    return cands, top
+
+
+COLS_TO_PRINT = ["TOI", "TIC ID", "TESS Mag", "Period (days)", "priority_score", "Comments"]
+
+
+def _batch_out_csv(path: str, root: str) -> str:
+    # Output name from the path below the snapshots' common directory, so
+    # nightly/a/tois.csv and nightly/b/tois.csv don't collide
+    rel = os.path.splitext(os.path.relpath(path, root))[0]
+    return f"m_dwarf_candidates_ranked_{rel.replace(os.sep, '_')}.csv"
+
+
+def _process_one(path: str, out_csv: str, top_k, parquet: bool):
+    # Batch worker: returns the printable top-K rows only when --top_k is given
+    cands, top = process_toi_csv(path, out_csv, top_k, parquet)
+    return path, out_csv, len(cands), (top[COLS_TO_PRINT] if top_k is not None else None)
+
+
+def _positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return n
+
 
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument("--toi_csv", required=True,
-                   help="Path to full TOI CSV (ExoFOP-style).")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--toi_csv",
+                     help="Path to full TOI CSV (ExoFOP-style).")
+    src.add_argument("--toi_csv_glob",
+                     help="Glob of TOI CSV snapshots; each is ranked in parallel into "
+                          "m_dwarf_candidates_ranked_<path>.csv (path below their common directory).")
+    p.add_argument("--top_k", type=_positive_int, default=None,
+                   help="Only print the K best candidates (per file in batch mode; skips the full "
+                        "sort, so the CSV is left unsorted).")
+    p.add_argument("--parquet", action="store_true",
+                   help="Also write a .parquet (zstd) next to each output CSV for fast reloads.")
 
     # Fixed because of location and conditions [NOT USED]
     #p.add_argument("--site_lat", type=float, default=31.043416667, help="Observer latitude (deg).")
@@ -129,20 +373,36 @@ def main():
     #p.add_argument("--strict", action="store_true", help="Require 100% astronomical night (overrides --dark_frac to 1.0).")
 
     args = p.parse_args()
-
-    # Read and keep original column names
-    df = pd.read_csv(args.toi_csv)
-
-    # Filter and rank
-    cands = filter_candidates(df).copy()
-    cands = rank_candidates(cands)
-    cands = cands.sort_values('priority_score', ascending=False).reset_index(drop=True)
-
-    cands.to_csv("m_dwarf_candidates_ranked.csv", index=False)
+    if args.parquet and pyarrow is None:
+        p.error("--parquet requires pyarrow")
+
+    if args.toi_csv_glob:
+        paths = sorted(glob.glob(args.toi_csv_glob))
+        if not paths:
+            p.error(f"--toi_csv_glob matched no files: {args.toi_csv_glob}")
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+        out_csvs = [_batch_out_csv(os.path.abspath(path), root) for path in paths]
+        if len(set(out_csvs)) != len(out_csvs):
+            p.error("--toi_csv_glob matched files that map to the same output name")
+
+        jobs = zip(paths, out_csvs)
+        if joblib is not None:
+            results = joblib.Parallel(n_jobs=-1)(
+                joblib.delayed(_process_one)(path, out_csv, args.top_k, args.parquet)
+                for path, out_csv in jobs)
+        else:
+            results = [_process_one(path, out_csv, args.top_k, args.parquet) for path, out_csv in jobs]
+        for path, out_csv, n, top in results:
+            print(f"{path}: {n} filtered + ranked candidates -> {out_csv}")
+            if top is not None:
+                print(top.to_string(index=False))
+        return
+
+    cands, top = process_toi_csv(args.toi_csv, "m_dwarf_candidates_ranked.csv",
+                                 args.top_k, args.parquet)
 
     print(f"Filtered + ranked candidates: {len(cands)}")
-    cols_to_print = ["TOI", "TIC ID", "TESS Mag", "Period (days)", "priority_score", "Comments"]
-    print(cands[cols_to_print].to_string(index=False))
+    print(top[COLS_TO_PRINT].to_string(index=False))
 
 
 if __name__ == "__main__":
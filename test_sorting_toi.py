@@ -0,0 +1,59 @@
+# Checks that every comment-gate backend agrees with FLAGS_PATTERN.search
+# Run:
+# python -m pytest -q test_sorting_toi.py
+
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sorting_toi
+
+COMMENTS = [
+    'false\npositive', 'v\nshaped', 'ok', None, 'binary', '',
+    'ébinary', 'é binary', 'binaryé', 'Ébinary ok', 'über-eb', 'xeb', 'EB',
+    'line one\nlow snr', 'centroid\noffset', 'v-shaped\n', '\nsb2', 'fp',
+]
+
+
+def _fuzz_comments(n=5000, seed=0):
+    rng = random.Random(seed)
+    tokens = ['false', 'positive', 'v', 'shaped', 'eb', 'binary', 'sb2', 'low', 'snr',
+              'fp', 'é', 'ü', 'Ébinary', 'EB', 'x', '\n', ' ', '-']
+    return [None if rng.random() < 0.05 else
+            ''.join(rng.choice(tokens) for _ in range(rng.randint(0, 8)))
+            for _ in range(n)]
+
+
+def _expected(comments):
+    return np.array([bool(c) and sorting_toi.FLAGS_PATTERN.search(c) is not None
+                     for c in comments])
+
+
+def _series_variants(comments):
+    yield pd.Series(comments, dtype=object)
+    if sorting_toi.pyarrow is not None:
+        pa = sorting_toi.pyarrow
+        yield pd.Series(comments, dtype=pd.ArrowDtype(pa.large_string()))
+        # Sliced, multi-chunk Arrow data exercises the offset-to-row mapping
+        padded = ['pad binary'] + comments
+        half = len(padded) // 2
+        chunked = pa.chunked_array([pa.array(padded[:half], type=pa.string()),
+                                    pa.array(padded[half:], type=pa.string())])
+        yield pd.Series(pd.arrays.ArrowExtensionArray(chunked)).iloc[1:].reset_index(drop=True)
+
+
+@pytest.mark.parametrize('comments', [COMMENTS, _fuzz_comments()], ids=['cases', 'fuzz'])
+def test_str_contains_path_matches_re(monkeypatch, comments):
+    monkeypatch.setattr(sorting_toi, 'FLAGS_DB', None)
+    for series in _series_variants(comments):
+        np.testing.assert_array_equal(sorting_toi.flagged_mask(series), _expected(comments))
+
+
+@pytest.mark.skipif(sorting_toi.FLAGS_DB is None or sorting_toi.pyarrow is None,
+                    reason='needs hyperscan and pyarrow')
+@pytest.mark.parametrize('comments', [COMMENTS, _fuzz_comments()], ids=['cases', 'fuzz'])
+def test_hyperscan_path_matches_re(comments):
+    for series in _series_variants(comments):
+        np.testing.assert_array_equal(sorting_toi.flagged_mask(series), _expected(comments))